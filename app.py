@@ -1,99 +1,111 @@
-from flask import Flask, render_template, request, jsonify, Response, send_file
-from models import db, Student, FaceEncoding, Timetable, Attendance, PendingConfirmation, Settings
+from flask import Flask, render_template, request, jsonify, Response, send_file, url_for, abort
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy.exc import IntegrityError
+from models import (
+    db, Student, FaceEncoding, Timetable, Attendance, PendingConfirmation, Settings,
+    add_missing_columns, create_missing_indexes, migrate_server_defaults, migrate_pending_payloads,
+    migrate_face_encodings, configure_attendance_cache
+)
 from face_utils import (
-    encode_face_from_base64, recognize_face, load_known_faces, 
-    add_face_encoding, image_to_base64, draw_face_box, 
-    cleanup_old_encodings, get_confidence_thresholds
+    encode_face_from_bytes, encode_face_from_base64, encode_faces_from_base64, recognize_face,
+    get_known_faces, add_face_encoding,
+    add_face_encodings, image_to_base64, image_to_thumbnail, draw_face_box,
+    cleanup_old_encodings, get_confidence_thresholds, warm_up_matcher
 )
-from datetime import datetime, date, time, timedelta
-import cv2
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import numpy as np
 import pandas as pd
 import json
 import os
 import base64
+import threading
+
+try:
+    import orjson
+except ImportError:  # Flask's standard JSON provider is used instead
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider using orjson for responses and request bodies"""
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 # Database configuration - use environment variable for production
 import os
 database_url = os.environ.get('DATABASE_URL', 'sqlite:///attendance.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+engine_options = {'pool_pre_ping': True}
+if database_url.startswith('sqlite'):
+    # Connections are shared with worker threads; wait on locks instead of failing
+    engine_options['connect_args'] = {'check_same_thread': False, 'timeout': 30}
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 
 db.init_app(app)
+configure_attendance_cache(os.environ.get('REDIS_URL'))
 
 # Create folders
-os.makedirs('exports', exist_ok=True)
 os.makedirs('known_faces', exist_ok=True)
 
-# Global variables for camera
-camera = None
-known_faces_cache = {}
-last_cache_update = None
-CACHE_UPDATE_INTERVAL = 60  # seconds
-
 # Track recently marked attendance to avoid duplicates
 recently_marked = {}  # {student_id: timestamp}
 MARK_COOLDOWN = 300  # 5 minutes cooldown
 
+# Adaptive learning runs on one background worker; updates beyond the backlog
+# limit are dropped since they only refine recognition
+ADAPTIVE_BACKLOG = 32
+adaptive_executor = ThreadPoolExecutor(max_workers=1)
+adaptive_slots = threading.BoundedSemaphore(ADAPTIVE_BACKLOG)
 
-def get_camera():
-    """Get or initialize camera"""
-    global camera
-    if camera is None:
-        camera = cv2.VideoCapture(0)
-        camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-    return camera
-
-
-def release_camera():
-    """Release camera resource"""
-    global camera
-    if camera is not None:
-        camera.release()
-        camera = None
 
-
-def get_known_faces():
-    """Get known faces with caching"""
-    global known_faces_cache, last_cache_update
-    
-    now = datetime.now()
-    if last_cache_update is None or (now - last_cache_update).seconds > CACHE_UPDATE_INTERVAL:
-        known_faces_cache = load_known_faces()
-        last_cache_update = now
-    
-    return known_faces_cache
+def _adaptive_update(student_id, encoding):
+    """Store an adaptive encoding and trim old ones, outside the request"""
+    try:
+        with app.app_context():
+            add_face_encoding(student_id, encoding, source='adaptive')
+            cleanup_old_encodings(student_id)
+    except Exception:
+        app.logger.exception('Adaptive learning update failed for student %s', student_id)
+    finally:
+        adaptive_slots.release()
 
 
-def refresh_known_faces():
-    """Force refresh of known faces cache"""
-    global known_faces_cache, last_cache_update
-    known_faces_cache = load_known_faces()
-    last_cache_update = datetime.now()
+def schedule_adaptive_update(student_id, encoding):
+    """Queue an adaptive learning update unless the backlog is full"""
+    if adaptive_slots.acquire(blocking=False):
+        adaptive_executor.submit(_adaptive_update, student_id, np.array(encoding))
 
 
 def get_current_class():
     """Get the current class based on timetable"""
-    now = datetime.now()
-    current_time = now.time()
-    current_day = now.weekday()
-    
-    timetable = Timetable.query.filter_by(day_of_week=current_day).all()
-    
-    for entry in timetable:
-        if entry.start_time <= current_time <= entry.end_time:
-            return entry
-    
-    return None
+    return Timetable.current_subject()
 
 
-# Initialize database
-with app.app_context():
+def init_db():
+    """Create tables and indexes, migrate legacy rows and store default settings"""
     db.create_all()
+    add_missing_columns()
+    # Before the defaults migration, which may rebuild the same table
+    migrate_pending_payloads()
+    migrate_server_defaults()
+    create_missing_indexes()
+    migrate_face_encodings()
     # Set default settings
     if Settings.get('high_confidence_threshold') is None:
         Settings.set('high_confidence_threshold', '0.6')
@@ -105,6 +117,14 @@ with app.app_context():
         Settings.set('adaptive_learning', 'true')
 
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database schema, run once per deploy before starting workers"""
+    init_db()
+    print('Database initialized.')
+
+
+
 # ==================== ROUTES ====================
 
 @app.route('/')
@@ -121,7 +141,9 @@ def dashboard():
     current_class = get_current_class()
     
     # Recent attendance
-    recent = Attendance.query.filter_by(date=today).order_by(Attendance.time_marked.desc()).limit(10).all()
+    recent = Attendance.query.options(db.joinedload(Attendance.student)).filter_by(date=today).order_by(
+        Attendance.time_marked.desc()
+    ).limit(10).all()
     
     return render_template('dashboard.html', 
                          total_students=total_students,
@@ -134,6 +156,7 @@ def dashboard():
 @app.route('/students')
 def students():
     """List all students"""
+    # The face count shown per student is the denormalized encodings_count
     all_students = Student.query.all()
     return render_template('students.html', students=all_students)
 
@@ -144,10 +167,17 @@ def register_student():
     if request.method == 'POST':
         data = request.get_json()
         
-        # Check if roll number exists
+        # Check if roll number exists, uncached as it guards the insert below
         if Student.query.filter_by(roll_number=data['roll_number']).first():
             return jsonify({'success': False, 'error': 'Roll number already exists'})
         
+        # Process face images
+        encodings = encode_faces_from_base64(data.get('images', []))
+        face_count = len(encodings)
+        
+        if face_count == 0:
+            return jsonify({'success': False, 'error': 'No face detected in any image'})
+        
         # Create student
         student = Student(
             name=data['name'],
@@ -156,24 +186,15 @@ def register_student():
             department=data['department']
         )
         db.session.add(student)
-        db.session.commit()
-        
-        # Process face images
-        face_count = 0
-        for image_data in data.get('images', []):
-            encoding, _ = encode_face_from_base64(image_data)
-            if encoding is not None:
-                add_face_encoding(student.id, encoding, source='registration')
-                face_count += 1
-        
-        if face_count == 0:
-            # No faces detected, delete student
-            db.session.delete(student)
-            db.session.commit()
-            return jsonify({'success': False, 'error': 'No face detected in any image'})
+        try:
+            db.session.flush()
+        except IntegrityError:
+            # Registered concurrently since the check above
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'Roll number already exists'})
         
-        # Refresh cache
-        refresh_known_faces()
+        # Student and encodings are committed together
+        add_face_encodings(student.id, encodings, source='registration')
         
         return jsonify({'success': True, 'message': f'Student registered with {face_count} face images'})
     
@@ -186,7 +207,6 @@ def delete_student(id):
     student = Student.query.get_or_404(id)
     db.session.delete(student)
     db.session.commit()
-    refresh_known_faces()
     return jsonify({'success': True})
 
 
@@ -241,8 +261,9 @@ def process_attendance():
     """Process a frame for attendance"""
     global recently_marked
     
-    data = request.get_json()
-    image_data = data.get('image')
+    # Frames arrive as a multipart JPEG file; JSON base64 is still accepted
+    upload = request.files.get('image')
+    image_data = upload.read() if upload else (request.get_json(silent=True) or {}).get('image')
     
     if not image_data:
         return jsonify({'success': False, 'error': 'No image provided'})
@@ -253,7 +274,10 @@ def process_attendance():
         return jsonify({'success': False, 'error': 'No class scheduled', 'no_class': True})
     
     # Encode face
-    encoding, image = encode_face_from_base64(image_data)
+    if upload:
+        encoding, image = encode_face_from_bytes(image_data)
+    else:
+        encoding, image = encode_face_from_base64(image_data)
     
     if encoding is None:
         return jsonify({'success': False, 'error': 'No face detected'})
@@ -272,7 +296,7 @@ def process_attendance():
         result['message'] = 'Unknown face detected'
         return jsonify(result)
     
-    student = Student.query.get(student_id)
+    student = Student.get_by_id_cached(student_id)
     result['student'] = {
         'id': student.id,
         'name': student.name,
@@ -296,13 +320,7 @@ def process_attendance():
             return jsonify(result)
     
     # Check if already marked today for this subject
-    existing = Attendance.query.filter_by(
-        student_id=student_id,
-        date=date.today(),
-        subject=current_class.subject
-    ).first()
-    
-    if existing:
+    if Attendance.is_marked_today(student_id, current_class.subject):
         result['message'] = f'{student.name} - Already marked for {current_class.subject}'
         result['already_marked'] = True
         return jsonify(result)
@@ -324,9 +342,7 @@ def process_attendance():
         
         # Adaptive learning - add this encoding if enabled
         if Settings.get('adaptive_learning', 'true') == 'true':
-            add_face_encoding(student_id, encoding, source='adaptive')
-            cleanup_old_encodings(student_id)
-            refresh_known_faces()
+            schedule_adaptive_update(student_id, encoding)
         
         result['message'] = f'✓ {student.name} - Attendance marked!'
         result['marked'] = True
@@ -338,8 +354,7 @@ def process_attendance():
             subject=current_class.subject,
             confidence=confidence
         )
-        pending.set_encoding(encoding)
-        pending.face_image = image_data
+        pending.set_payload(encoding, image_to_thumbnail(image))
         db.session.add(pending)
         db.session.commit()
         
@@ -363,13 +378,7 @@ def confirm_attendance(id):
         student_id = correct_student_id or pending.student_id
         
         # Check if already marked
-        existing = Attendance.query.filter_by(
-            student_id=student_id,
-            date=date.today(),
-            subject=pending.subject
-        ).first()
-        
-        if not existing:
+        if not Attendance.is_marked_today(student_id, pending.subject):
             # Mark attendance
             attendance_record = Attendance(
                 student_id=student_id,
@@ -383,10 +392,7 @@ def confirm_attendance(id):
             
             # Adaptive learning - add encoding to improve recognition
             if Settings.get('adaptive_learning', 'true') == 'true':
-                encoding = np.array(pending.get_encoding())
-                add_face_encoding(student_id, encoding, source='adaptive')
-                cleanup_old_encodings(student_id)
-                refresh_known_faces()
+                schedule_adaptive_update(student_id, pending.get_payload()[0])
     
     # Delete pending record
     db.session.delete(pending)
@@ -395,27 +401,54 @@ def confirm_attendance(id):
     return jsonify({'success': True})
 
 
+@app.route('/attendance/pending/clear', methods=['POST'])
+def clear_pending():
+    """Dismiss the given pending confirmations, or all older than a number of days"""
+    data = request.get_json() or {}
+    
+    if 'ids' in data:
+        removed = PendingConfirmation.bulk_delete([int(id) for id in data['ids']])
+    else:
+        removed = PendingConfirmation.purge_older_than(int(data.get('older_than_days', 1)))
+    
+    return jsonify({'success': True, 'removed': removed})
+
+
 @app.route('/attendance/pending')
 def get_pending():
     """Get all pending confirmations"""
-    pending = PendingConfirmation.query.all()
+    # Encodings and images are not part of the listing
+    rows = db.session.query(PendingConfirmation, Student).join(
+        Student, Student.id == PendingConfirmation.student_id
+    ).options(
+        db.defer(PendingConfirmation.payload)
+    ).all()
     result = []
     
-    for p in pending:
-        student = Student.query.get(p.student_id)
+    for p, student in rows:
         result.append({
             'id': p.id,
             'student_name': student.name,
             'student_roll': student.roll_number,
             'confidence': p.confidence,
             'subject': p.subject,
-            'image': p.face_image,
+            'image': url_for('pending_image', id=p.id),
             'created_at': p.created_at.strftime('%H:%M:%S')
         })
     
     return jsonify(result)
 
 
+@app.route('/attendance/pending/<int:id>/image')
+def pending_image(id):
+    """Serve the face thumbnail captured for a pending confirmation"""
+    pending = db.session.get(PendingConfirmation, id)
+    if pending is None:
+        abort(404)
+    _, face_image = pending.get_payload()
+    return Response(face_image, mimetype='image/jpeg')
+
+
 @app.route('/reports')
 def reports():
     """View and export reports"""
@@ -430,6 +463,26 @@ def reports():
     return render_template('reports.html', dates=dates, classes=classes)
 
 
+REPORT_COLUMNS = [
+    'Roll Number', 'Student Name', 'Class', 'Department',
+    'Subject', 'Time Marked', 'Confidence', 'Status'
+]
+
+
+def get_report_rows(report_date, class_name):
+    """Get attendance rows for a report as plain tuples in REPORT_COLUMNS order"""
+    query = db.session.query(Attendance).join(Student).filter(Attendance.date == report_date)
+    
+    if class_name:
+        query = query.filter(Student.class_name == class_name)
+    
+    # Scalar columns only, no ORM objects to build for large reports
+    return query.with_entities(
+        Student.roll_number, Student.name, Student.class_name, Student.department,
+        Attendance.subject, Attendance.time_marked, Attendance.confidence, Attendance.status
+    ).all()
+
+
 @app.route('/reports/data')
 def get_report_data():
     """Get attendance data for reporting"""
@@ -439,25 +492,17 @@ def get_report_data():
     if isinstance(report_date, str):
         report_date = datetime.strptime(report_date, '%Y-%m-%d').date()
     
-    query = db.session.query(Attendance, Student).join(Student)
-    query = query.filter(Attendance.date == report_date)
-    
-    if class_name:
-        query = query.filter(Student.class_name == class_name)
-    
-    records = query.all()
-    
     result = []
-    for attendance, student in records:
+    for row in get_report_rows(report_date, class_name):
         result.append({
-            'student_name': student.name,
-            'roll_number': student.roll_number,
-            'class_name': student.class_name,
-            'department': student.department,
-            'subject': attendance.subject,
-            'time': attendance.time_marked.strftime('%H:%M:%S'),
-            'confidence': f'{attendance.confidence:.0%}',
-            'status': attendance.status
+            'student_name': row.name,
+            'roll_number': row.roll_number,
+            'class_name': row.class_name,
+            'department': row.department,
+            'subject': row.subject,
+            'time': row.time_marked.strftime('%H:%M:%S'),
+            'confidence': f'{row.confidence:.0%}',
+            'status': row.status
         })
     
     return jsonify(result)
@@ -472,35 +517,22 @@ def export_report():
     if isinstance(report_date, str):
         report_date = datetime.strptime(report_date, '%Y-%m-%d').date()
     
-    query = db.session.query(Attendance, Student).join(Student)
-    query = query.filter(Attendance.date == report_date)
-    
-    if class_name:
-        query = query.filter(Student.class_name == class_name)
-    
-    records = query.all()
-    
-    data = []
-    for attendance, student in records:
-        data.append({
-            'Roll Number': student.roll_number,
-            'Student Name': student.name,
-            'Class': student.class_name,
-            'Department': student.department,
-            'Subject': attendance.subject,
-            'Time Marked': attendance.time_marked.strftime('%H:%M:%S'),
-            'Confidence': f'{attendance.confidence:.0%}',
-            'Status': attendance.status
-        })
-    
-    df = pd.DataFrame(data)
+    df = pd.DataFrame.from_records(get_report_rows(report_date, class_name), columns=REPORT_COLUMNS)
+    df['Time Marked'] = [t.strftime('%H:%M:%S') for t in df['Time Marked']]
+    df['Confidence'] = df['Confidence'].map('{:.0%}'.format)
     
     filename = f'attendance_{report_date}_{class_name or "all"}.xlsx'
-    filepath = os.path.join('exports', filename)
     
-    df.to_excel(filepath, index=False)
+    # Build the workbook in memory instead of a file under exports/
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False)
+    output.seek(0)
     
-    return send_file(filepath, as_attachment=True, download_name=filename)
+    return send_file(
+        output, as_attachment=True, download_name=filename,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
 
 
 @app.route('/settings')
@@ -586,5 +618,9 @@ if __name__ == '__main__':
     print("   Click 'Advanced' -> 'Proceed anyway' to continue.")
     print("="*60 + "\n")
     
+    with app.app_context():
+        init_db()
+    warm_up_matcher()
+    
     # Run with HTTPS
     app.run(debug=True, host='0.0.0.0', port=5000, ssl_context=('cert.pem', 'key.pem'))
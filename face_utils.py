@@ -1,14 +1,70 @@
 import face_recognition
+import dlib
 import numpy as np
 import cv2
 import base64
-from models import db, Student, FaceEncoding, Settings
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from models import db, Student, FaceEncoding, Settings, ENCODING_DIM, get_matrix_version
+
+try:
+    from pybase64 import b64decode
+except ImportError:  # Standard library decoder, without SIMD
+    from base64 import b64decode
+
+try:
+    import faiss
+except ImportError:  # Fall back to a brute-force scan
+    faiss = None
+
+try:
+    from numba import config as numba_config, njit, prange
+except ImportError:  # Fall back to the vectorized NumPy scan
+    njit = None
+else:
+    # The kernel runs on concurrent request threads and in forked Gunicorn
+    # workers; 'safe' selects TBB, the only layer that is both thread- and
+    # fork-safe (GNU OpenMP aborts after fork, workqueue on concurrent calls)
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        numba_config.THREADING_LAYER = 'safe'
 
 # Default confidence thresholds
 DEFAULT_HIGH_CONFIDENCE = 0.6  # Distance below this = high confidence match
 DEFAULT_LOW_CONFIDENCE = 0.5   # Distance below this = low confidence (needs confirmation)
 # Distance above LOW_CONFIDENCE = unknown face
 
+# Encodings stay well within +/-0.5 per dimension, so they are matched as
+# int8 codes on that range; the rounding error is far below the thresholds
+ENCODING_RANGE = 0.5
+ENCODING_SCALE = 127.0 / ENCODING_RANGE
+
+# Longest image side handed to the HOG face detector
+MAX_DETECTION_SIZE = 600
+
+# Faces at least this tall after downscaling are encoded without going back
+# to full resolution (dlib aligns faces to 150 px chips before encoding)
+MIN_ENCODING_FACE_SIZE = 150
+
+# Uploads larger than this are decoded at half resolution by libjpeg
+REDUCED_DECODE_MIN_BYTES = 200 * 1024
+
+# Longest side and JPEG quality of stored pending-confirmation thumbnails
+THUMBNAIL_SIZE = 160
+THUMBNAIL_QUALITY = 70
+
+# Rows compared per step of the NumPy scan, and the fraction of the low
+# threshold under which a match ends the scan early
+SCAN_CHUNK_ROWS = 256
+EARLY_EXIT_FACTOR = 0.8
+
+# Per-thread scratch images reused by frames of the same size
+_scratch = threading.local()
+
+# Known faces cache and the encodings version it was built from
+_known_faces_cache = None
+_known_faces_version = None
+
 
 def get_confidence_thresholds():
     """Get confidence thresholds from settings"""
@@ -17,6 +73,15 @@ def get_confidence_thresholds():
     return high, low
 
 
+def _scratch_image(name, shape):
+    """Get a reusable per-thread uint8 image buffer of the given shape"""
+    buffer = getattr(_scratch, name, None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.uint8)
+        setattr(_scratch, name, buffer)
+    return buffer
+
+
 def encode_face(image):
     """
     Extract face encoding from an image.
@@ -27,42 +92,89 @@ def encode_face(image):
     Returns:
         tuple: (face_encoding, face_location) or (None, None) if no face found
     """
+    # Downscale first so the color conversion only touches detection pixels;
+    # HOG cost grows with pixel count
+    height, width = image.shape[:2]
+    scale = MAX_DETECTION_SIZE / max(height, width)
+    if scale < 1.0:
+        size = (round(width * scale), round(height * scale))
+        small_bgr = cv2.resize(image, size, dst=_scratch_image('small', (size[1], size[0], 3)),
+                               interpolation=cv2.INTER_AREA)
+    else:
+        scale = 1.0
+        small_bgr = image
+    
     # Convert BGR to RGB
-    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    small_rgb = cv2.cvtColor(small_bgr, cv2.COLOR_BGR2RGB, dst=_scratch_image('rgb', small_bgr.shape))
     
     # Find face locations
-    face_locations = face_recognition.face_locations(rgb_image, model='hog')
+    face_locations = face_recognition.face_locations(small_rgb, model='hog')
     
     if not face_locations:
         return None, None
     
-    # Get face encoding for the first face found
-    face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+    small_location = face_locations[0]
+    location = tuple(int(round(v / scale)) for v in small_location)
+    
+    # Faces big enough for the encoder's face chip are encoded from the small
+    # image; smaller ones need the detail of the full-resolution frame
+    top, _, bottom, _ = small_location
+    if scale == 1.0 or bottom - top >= MIN_ENCODING_FACE_SIZE:
+        face_encodings = face_recognition.face_encodings(small_rgb, [small_location])
+    else:
+        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=_scratch_image('full_rgb', image.shape))
+        face_encodings = face_recognition.face_encodings(rgb_image, [location])
     
     if not face_encodings:
         return None, None
     
-    return face_encodings[0], face_locations[0]
+    return face_encodings[0], location
 
 
-def encode_face_from_base64(base64_string):
+def decode_image_bytes(img_data):
     """
-    Extract face encoding from a base64 encoded image.
+    Decode uploaded image file bytes to an OpenCV image.
     
-    Args:
-        base64_string: Base64 encoded image string
+    Oversized uploads are decoded at half resolution, skipping detail the
+    HOG detector would discard anyway.
     
     Returns:
-        tuple: (face_encoding, image) or (None, None) if no face found
+        numpy array (BGR format), or None if the data is not an image
     """
+    nparr = np.frombuffer(img_data, np.uint8)
+    if len(img_data) > REDUCED_DECODE_MIN_BYTES:
+        return cv2.imdecode(nparr, cv2.IMREAD_REDUCED_COLOR_2)
+    return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+
+
+def decode_base64_upload(base64_string):
+    """Decode a base64 encoded upload, with or without data URL prefix, to file bytes"""
     # Remove data URL prefix if present
     if ',' in base64_string:
         base64_string = base64_string.split(',')[1]
     
-    # Decode base64 to image
-    img_data = base64.b64decode(base64_string)
-    nparr = np.frombuffer(img_data, np.uint8)
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return b64decode(base64_string)
+
+
+def decode_upload(base64_string):
+    """Decode a base64 encoded upload to an OpenCV image, see decode_image_bytes()"""
+    return decode_image_bytes(decode_base64_upload(base64_string))
+
+
+def encode_face_from_bytes(img_data):
+    """
+    Extract face encoding from uploaded image file bytes.
+    
+    Args:
+        img_data: JPEG or PNG file contents
+    
+    Returns:
+        tuple: (face_encoding, image) or (None, None) if no face found.
+               Oversized uploads are decoded at half resolution, so the
+               returned image (and any face location found in it) uses the
+               reduced frame's coordinates.
+    """
+    image = decode_image_bytes(img_data)
     
     if image is None:
         return None, None
@@ -71,35 +183,183 @@ def encode_face_from_base64(base64_string):
     return encoding, image
 
 
-def recognize_face(face_encoding, known_encodings_dict):
+def encode_face_from_base64(base64_string):
+    """
+    Extract face encoding from a base64 encoded image.
+    
+    Args:
+        base64_string: Base64 encoded image string
+    
+    Returns:
+        tuple: (face_encoding, image) or (None, None) if no face found,
+               see encode_face_from_bytes()
+    """
+    return encode_face_from_bytes(decode_base64_upload(base64_string))
+
+
+def encode_faces_batch(images):
+    """
+    Extract face encodings from several images with one CNN pass per size.
+    
+    Runs dlib's CNN detector through batch_face_locations, which needs a
+    CUDA build of dlib to be worthwhile. Images are grouped by shape since
+    a batch must share one size.
+    
+    Args:
+        images: list of numpy arrays (BGR format from OpenCV)
+    
+    Returns:
+        list: face encodings of the images where a face was found
+    """
+    batches = {}
+    for image in images:
+        batches.setdefault(image.shape, []).append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    
+    encodings = []
+    for rgb_images in batches.values():
+        batch_locations = face_recognition.batch_face_locations(
+            rgb_images, number_of_times_to_upsample=0, batch_size=len(rgb_images)
+        )
+        # Encode the first face of each image from the precomputed locations
+        for rgb_image, face_locations in zip(rgb_images, batch_locations):
+            if face_locations:
+                encodings.extend(face_recognition.face_encodings(rgb_image, face_locations[:1]))
+    
+    return encodings
+
+
+def encode_faces_from_base64(base64_strings):
+    """
+    Extract face encodings from several base64 encoded images in parallel.
+    
+    Args:
+        base64_strings: list of base64 encoded image strings
+    
+    Returns:
+        list: face encodings of the images where a face was found
+    """
+    if not base64_strings:
+        return []
+    
+    # JPEG decoding and dlib release the GIL, so threads overlap the work
+    workers = min(len(base64_strings), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        images = [image for image in executor.map(decode_upload, base64_strings) if image is not None]
+        
+        if dlib.DLIB_USE_CUDA:
+            return encode_faces_batch(images)
+        
+        results = list(executor.map(encode_face, images))
+    
+    return [encoding for encoding, _ in results if encoding is not None]
+
+
+def quantize_encodings(encodings):
+    """Convert float face encodings to the int8 codes used for matching"""
+    codes = np.rint(np.asarray(encodings, dtype=np.float32) * ENCODING_SCALE)
+    return np.clip(codes, -128, 127).astype(np.int8)
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _closest_code(known_codes, query_codes):
+        """Row and squared distance of the nearest int8 code, rows scanned in parallel"""
+        distances_sq = np.empty(known_codes.shape[0], dtype=np.int32)
+        for row in prange(known_codes.shape[0]):
+            # The fixed ENCODING_DIM trip count is a compile-time constant,
+            # letting LLVM fully unroll this into packed SIMD multiply-adds
+            total = np.int32(0)
+            for k in range(ENCODING_DIM):
+                diff = np.int32(known_codes[row, k]) - np.int32(query_codes[k])
+                total += diff * diff
+            distances_sq[row] = total
+        best_row = distances_sq.argmin()
+        return best_row, distances_sq[best_row]
+else:
+    _closest_code = None
+
+
+def warm_up_matcher():
+    """
+    Compile the Numba kernel up front so the first frame does not pay for it.
+    
+    Call it in each worker process after forking, not in a preloading parent.
+    Nothing is done when FAISS handles the matching.
+    """
+    if faiss is None and _closest_code is not None:
+        codes = np.zeros((1, ENCODING_DIM), dtype=np.int8)
+        _closest_code(codes, codes[0])
+
+
+def find_closest_face(face_encoding, known_faces, stop_distance=None):
+    """
+    Find the known encoding closest to a face encoding.
+    
+    Args:
+        face_encoding: numpy array of the face to look up
+        known_faces: (codes, student_ids, index) tuple from load_known_faces()
+        stop_distance: optional distance below which the NumPy scan may stop
+                       early and return that match instead of the closest one
+    
+    Returns:
+        tuple: (row, distance) of the nearest known encoding
+    """
+    known_codes, _, index = known_faces
+    query = np.ascontiguousarray(face_encoding, dtype=np.float32).reshape(1, ENCODING_DIM)
+    
+    if index is not None:
+        distances_sq, rows = index.search(query, 1)
+        return int(rows[0, 0]), float(np.sqrt(distances_sq[0, 0]))
+    
+    query_codes = quantize_encodings(query)
+    
+    if _closest_code is not None:
+        row, distance_sq = _closest_code(known_codes, query_codes[0])
+        return int(row), float(np.sqrt(distance_sq)) / ENCODING_SCALE
+    
+    stop_distance_sq = -1 if stop_distance is None else (stop_distance * ENCODING_SCALE) ** 2
+    best_row, best_distance_sq = -1, np.iinfo(np.int32).max
+    
+    # Squared distances one vectorized chunk at a time; int8 differences fit
+    # int16 and 128 squared terms cannot overflow int32
+    for start in range(0, len(known_codes), SCAN_CHUNK_ROWS):
+        diffs = np.subtract(known_codes[start:start + SCAN_CHUNK_ROWS], query_codes, dtype=np.int16)
+        distances_sq = np.einsum('ij,ij->i', diffs, diffs, dtype=np.int32)
+        row = int(distances_sq.argmin())
+        
+        if distances_sq[row] < best_distance_sq:
+            best_row, best_distance_sq = start + row, int(distances_sq[row])
+        
+        if best_distance_sq < stop_distance_sq:
+            break
+    
+    return best_row, float(np.sqrt(best_distance_sq)) / ENCODING_SCALE
+
+
+def recognize_face(face_encoding, known_faces):
     """
     Compare a face encoding against known encodings.
     
     Args:
         face_encoding: numpy array of the face to recognize
-        known_encodings_dict: dict mapping student_id to list of encodings
+        known_faces: (encodings, student_ids, index) tuple from load_known_faces()
     
     Returns:
         tuple: (student_id, confidence, match_type)
                match_type: 'high', 'low', or 'unknown'
     """
-    if not known_encodings_dict:
+    student_ids = known_faces[1]
+    
+    if len(student_ids) == 0:
         return None, 0, 'unknown'
     
     high_threshold, low_threshold = get_confidence_thresholds()
     
-    best_match_id = None
-    best_distance = float('inf')
-    
-    # Compare against all known faces
-    for student_id, encodings in known_encodings_dict.items():
-        for known_encoding in encodings:
-            # Calculate face distance (lower = more similar)
-            distance = face_recognition.face_distance([known_encoding], face_encoding)[0]
-            
-            if distance < best_distance:
-                best_distance = distance
-                best_match_id = student_id
+    # Any match this close is 'high' anyway, so the scan need not go on
+    best_index, best_distance = find_closest_face(
+        face_encoding, known_faces, stop_distance=low_threshold * EARLY_EXIT_FACTOR
+    )
+    best_match_id = int(student_ids[best_index])
     
     # Convert distance to confidence (0-1 scale, higher = better)
     confidence = 1 - best_distance
@@ -116,27 +376,54 @@ def recognize_face(face_encoding, known_encodings_dict):
     return best_match_id, confidence, match_type
 
 
+def build_face_index(known_encodings):
+    """
+    Build a FAISS index over a matrix of known encodings.
+    
+    Returns:
+        faiss.IndexScalarQuantizer storing 8-bit codes, or None if FAISS is
+        not installed or there are no encodings to index
+    """
+    if faiss is None or len(known_encodings) == 0:
+        return None
+    
+    index = faiss.IndexScalarQuantizer(ENCODING_DIM, faiss.ScalarQuantizer.QT_8bit_uniform, faiss.METRIC_L2)
+    # Training on the range bounds pins the same +/-ENCODING_RANGE grid
+    bounds = np.repeat(np.array([[-ENCODING_RANGE], [ENCODING_RANGE]], dtype=np.float32), ENCODING_DIM, axis=1)
+    index.train(bounds)
+    index.add(np.ascontiguousarray(known_encodings, dtype=np.float32))
+    return index
+
+
 def load_known_faces():
     """
     Load all known face encodings from database.
     
     Returns:
-        dict: mapping student_id to list of face encodings
+        tuple: (codes, student_ids, index) where codes is an (N, 128) int8
+               matrix of quantized encodings, student_ids the owning student
+               of each row and index a FAISS index over the same encodings
+               (None without FAISS)
     """
-    known_encodings = {}
+    known_encodings, student_ids = Student.rebuild_matrix()
     
-    face_records = FaceEncoding.query.all()
+    if not len(student_ids):
+        return np.empty((0, ENCODING_DIM), dtype=np.int8), student_ids, None
     
-    for record in face_records:
-        student_id = record.student_id
-        encoding = np.array(record.get_encoding())
-        
-        if student_id not in known_encodings:
-            known_encodings[student_id] = []
-        
-        known_encodings[student_id].append(encoding)
+    return quantize_encodings(known_encodings), student_ids, build_face_index(known_encodings)
+
+
+def get_known_faces():
+    """Get known faces, reloading them from the database only when stale"""
+    global _known_faces_cache, _known_faces_version
     
-    return known_encodings
+    # Read the version first so a change committed during the load is not lost
+    version = get_matrix_version()
+    if _known_faces_cache is None or version != _known_faces_version:
+        _known_faces_cache = load_known_faces()
+        _known_faces_version = version
+    
+    return _known_faces_cache
 
 
 def add_face_encoding(student_id, encoding, source='registration'):
@@ -147,15 +434,25 @@ def add_face_encoding(student_id, encoding, source='registration'):
         student_id: ID of the student
         encoding: numpy array of face encoding
         source: 'registration' or 'adaptive'
+    """
+    add_face_encodings(student_id, [encoding], source)
+
+
+def add_face_encodings(student_id, encodings, source='registration'):
+    """
+    Add several face encodings for a student in a single bulk insert.
+    
+    Args:
+        student_id: ID of the student
+        encodings: list of numpy arrays of face encodings
+        source: 'registration' or 'adaptive'
     
     Returns:
-        FaceEncoding object
+        int: number of encodings stored
     """
-    face_record = FaceEncoding(student_id=student_id, source=source)
-    face_record.set_encoding(encoding)
-    db.session.add(face_record)
+    count = FaceEncoding.bulk_create(student_id, encodings, source)
     db.session.commit()
-    return face_record
+    return count
 
 
 def image_to_base64(image):
@@ -164,11 +461,20 @@ def image_to_base64(image):
     return base64.b64encode(buffer).decode('utf-8')
 
 
+def image_to_thumbnail(image):
+    """Convert OpenCV image to small JPEG thumbnail bytes"""
+    scale = THUMBNAIL_SIZE / max(image.shape[:2])
+    if scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+    return buffer.tobytes()
+
+
 def base64_to_image(base64_string):
     """Convert base64 string to OpenCV image"""
     if ',' in base64_string:
         base64_string = base64_string.split(',')[1]
-    img_data = base64.b64decode(base64_string)
+    img_data = b64decode(base64_string)
     nparr = np.frombuffer(img_data, np.uint8)
     return cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
@@ -222,15 +528,14 @@ def cleanup_old_encodings(student_id):
     max_encodings = get_max_encodings_per_student()
     
     # Count current encodings
-    encodings = FaceEncoding.query.filter_by(student_id=student_id).order_by(FaceEncoding.created_at.desc()).all()
+    excess = (db.session.query(Student.encodings_count).filter_by(id=student_id).scalar() or 0) - max_encodings
     
-    if len(encodings) > max_encodings:
-        # Keep registration encodings, remove oldest adaptive ones
-        adaptive_encodings = [e for e in encodings if e.source == 'adaptive']
-        
-        # Remove excess adaptive encodings (oldest first)
-        excess = len(encodings) - max_encodings
-        for encoding in adaptive_encodings[-excess:]:
-            db.session.delete(encoding)
+    if excess > 0:
+        # Keep registration encodings, remove oldest adaptive ones in one statement
+        oldest_adaptive = db.select(FaceEncoding.id).filter_by(
+            student_id=student_id, source='adaptive'
+        ).order_by(FaceEncoding.created_at.asc(), FaceEncoding.id.asc()).limit(excess)
         
+        FaceEncoding.query.filter(FaceEncoding.id.in_(oldest_adaptive)).delete(synchronize_session=False)
+        Student.refresh_encodings(student_id)
         db.session.commit()
@@ -0,0 +1,10 @@
+"""
+Gunicorn settings, read automatically from the working directory
+"""
+
+
+def post_fork(server, worker):
+    # Compile the matching kernel in each worker rather than in the
+    # preloading master, so no Numba threads exist before the fork
+    from face_utils import warm_up_matcher
+    warm_up_matcher()
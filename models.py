@@ -1,9 +1,71 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
+import base64
 import json
+import sqlite3
+import struct
+from collections import namedtuple
+from functools import lru_cache
+import threading
+import time
+import msgspec
+import numpy as np
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
+
+try:
+    import orjson
+except ImportError:  # Standard library parser is used instead
+    orjson = None
+
+try:
+    import redis
+except ImportError:  # Marked attendance is cached in-process only
+    redis = None
 
 db = SQLAlchemy()
 
+
+@event.listens_for(Engine, 'connect')
+def _tune_sqlite(dbapi_connection, connection_record):
+    """Use WAL so recognition writes do not block dashboard reads"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MiB
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MiB
+    cursor.close()
+
+
+# Timetable.day_of_week values, Monday first like date.weekday()
+DAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+# Length of a face_recognition encoding vector
+ENCODING_DIM = 128
+
+# Stored face encodings are a little-endian float32 scale followed by the
+# int8 codes of the vector; older rows hold the raw float32 vector instead
+QUANTIZED_ENCODING_SIZE = 4 + ENCODING_DIM
+FLOAT_ENCODING_SIZE = 4 * ENCODING_DIM
+
+# Header of Student.encodings_blob: encoding count and dimension, followed
+# by the stacked little-endian float32 matrix
+ENCODINGS_HEADER = struct.Struct('<II')
+
+# Settings row bumped in every transaction that adds or removes face
+# encodings, so each worker's cached matrix knows when it is stale
+MATRIX_VERSION_KEY = 'encoding_matrix_version'
+
+# Same for students, read through the settings cache to key the cached
+# student lookups, so other workers' changes show within Settings.CACHE_TTL
+STUDENTS_VERSION_KEY = 'students_version'
+
 class Student(db.Model):
     __tablename__ = 'students'
     
@@ -12,14 +74,100 @@ class Student(db.Model):
     roll_number = db.Column(db.String(50), unique=True, nullable=False)
     class_name = db.Column(db.String(50), nullable=False)
     department = db.Column(db.String(100), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    
+    # All of the student's encodings stacked in one blob, rebuilt from
+    # FaceEncoding rows whenever they change; deferred as only matching reads it
+    encodings_blob = db.deferred(db.Column(db.LargeBinary))
+    encodings_count = db.Column(db.Integer, default=0)
     
     # Relationships
     face_encodings = db.relationship('FaceEncoding', backref='student', lazy=True, cascade='all, delete-orphan')
     attendances = db.relationship('Attendance', backref='student', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
-        return f'<Student {self.name} - {self.roll_number}>'
+        return f'<{type(self).__name__} {self.id}>'
+    
+    @classmethod
+    def get_by_id_cached(cls, student_id):
+        """Look up a student by id as a StudentRecord, cached until students change"""
+        try:
+            return _student_by_id(get_students_version(), student_id)
+        except LookupError:
+            return None
+    
+    def get_encodings_matrix(self):
+        """Unpack encodings_blob to a (read-only) (count, 128) float32 matrix"""
+        if not self.encodings_blob:
+            return np.empty((0, ENCODING_DIM), dtype=np.float32)
+        count, dim = ENCODINGS_HEADER.unpack_from(self.encodings_blob)
+        return np.frombuffer(self.encodings_blob, dtype='<f4', offset=ENCODINGS_HEADER.size).reshape(count, dim)
+    
+    @classmethod
+    def refresh_encodings(cls, student_id):
+        """Rewrite a student's encodings_blob from their FaceEncoding rows, without committing"""
+        # Lock the student row first, so a concurrent transaction adding
+        # encodings for the same student waits and then reads ours too.
+        # NO KEY UPDATE does not conflict with the key-share locks taken by
+        # the face_encodings foreign key, which would deadlock
+        db.session.execute(db.select(cls.id).where(cls.id == student_id).with_for_update(key_share=True))
+        blobs = db.session.scalars(
+            db.select(FaceEncoding.encoding).filter_by(student_id=student_id).order_by(FaceEncoding.id)
+        ).all()
+        encodings = unpack_encodings(blobs)
+        
+        db.session.execute(db.update(cls).where(cls.id == student_id).values(
+            encodings_blob=ENCODINGS_HEADER.pack(*encodings.shape) + encodings.astype('<f4').tobytes(),
+            encodings_count=len(blobs)
+        ))
+    
+    @classmethod
+    def rebuild_matrix(cls):
+        """
+        Load every student's encodings as one contiguous matrix.
+        
+        Returns:
+            tuple: (encodings, student_ids) where encodings is an (N, 128)
+                   float32 matrix and student_ids the owning student of each row
+        """
+        rows = db.session.query(cls.id, cls.encodings_blob).filter(cls.encodings_count > 0).all()
+        
+        counts = np.fromiter(
+            (ENCODINGS_HEADER.unpack_from(row.encodings_blob)[0] for row in rows), dtype=np.int64, count=len(rows)
+        )
+        encodings = np.frombuffer(
+            b''.join(memoryview(row.encodings_blob)[ENCODINGS_HEADER.size:] for row in rows), dtype='<f4'
+        )
+        student_ids = np.repeat(np.fromiter((row.id for row in rows), dtype=np.int32, count=len(rows)), counts)
+        return encodings.reshape(-1, ENCODING_DIM), student_ids
+
+
+# Detached, immutable copy of a student row, safe to share across requests
+StudentRecord = namedtuple('StudentRecord', 'id name roll_number class_name department')
+
+
+def _student_record(query):
+    row = query.with_entities(
+        Student.id, Student.name, Student.roll_number, Student.class_name, Student.department
+    ).first()
+    if row is None:
+        # Raised rather than returned so lru_cache does not keep the miss
+        raise LookupError('student not found')
+    return StudentRecord(*row)
+
+
+# Keyed on the students version, so entries from before any worker's
+# change are never hit again and age out of the cache
+@lru_cache(maxsize=4096)
+def _student_by_id(version, student_id):
+    return _student_record(Student.query.filter_by(id=student_id))
+
+
+@event.listens_for(Student, 'after_insert')
+@event.listens_for(Student, 'after_update')
+@event.listens_for(Student, 'after_delete')
+def _student_flushed(mapper, connection, target):
+    object_session(target).info['students_changed'] = True
 
 
 class FaceEncoding(db.Model):
@@ -27,21 +175,115 @@ class FaceEncoding(db.Model):
     __tablename__ = 'face_encodings'
     
     id = db.Column(db.Integer, primary_key=True)
-    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
-    encoding = db.Column(db.Text, nullable=False)  # JSON-encoded numpy array
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False, index=True)
+    encoding = db.Column(db.LargeBinary, nullable=False)  # float32 scale + int8 codes, see pack_encoding()
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     source = db.Column(db.String(50), default='registration')  # 'registration' or 'adaptive'
     
     def set_encoding(self, encoding_array):
-        """Convert numpy array to JSON string"""
-        self.encoding = json.dumps(encoding_array.tolist())
+        """Quantize numpy array into scaled int8 bytes"""
+        self.encoding = pack_encoding(encoding_array)
     
     def get_encoding(self):
-        """Convert JSON string back to list"""
-        return json.loads(self.encoding)
+        """Unpack stored bytes back to a float32 numpy array"""
+        return unpack_encodings([self.encoding])[0]
+    
+    @classmethod
+    def bulk_create(cls, student_id, encodings, source='registration'):
+        """Insert several encodings for a student in one executemany, without committing"""
+        rows = [
+            {'student_id': student_id, 'encoding': pack_encoding(encoding), 'source': source}
+            for encoding in encodings
+        ]
+        if rows:
+            db.session.execute(db.insert(cls), rows)
+            Student.refresh_encodings(student_id)
+        return len(rows)
     
     def __repr__(self):
-        return f'<FaceEncoding for Student {self.student_id}>'
+        return f'<{type(self).__name__} {self.id}>'
+
+
+def pack_encoding(encoding):
+    """Quantize an encoding to int8 codes with its own float32 scale"""
+    encoding = np.asarray(encoding, dtype=np.float32)
+    scale = np.float32(np.abs(encoding).max() / 127.0) or np.float32(1.0)
+    codes = np.round(encoding / scale).astype(np.int8)
+    return scale.astype('<f4').tobytes() + codes.tobytes()
+
+
+def unpack_encodings(blobs):
+    """Decode stored encodings, quantized or legacy float32, into an (N, 128) float32 matrix"""
+    encodings = np.empty((len(blobs), ENCODING_DIM), dtype=np.float32)
+    quantized = np.fromiter((len(blob) == QUANTIZED_ENCODING_SIZE for blob in blobs), dtype=bool, count=len(blobs))
+    
+    if quantized.any():
+        packed = np.frombuffer(b''.join(blob for blob, q in zip(blobs, quantized) if q), dtype=np.uint8)
+        packed = packed.reshape(-1, QUANTIZED_ENCODING_SIZE)
+        scales = packed[:, :4].copy().view('<f4')
+        encodings[quantized] = packed[:, 4:].view(np.int8) * scales
+    if not quantized.all():
+        legacy = b''.join(blob for blob, q in zip(blobs, quantized) if not q)
+        encodings[~quantized] = np.frombuffer(legacy, dtype='<f4').reshape(-1, ENCODING_DIM)
+    
+    return encodings
+
+
+def get_matrix_version():
+    """Version of the committed face encodings, see Student.rebuild_matrix()"""
+    # Read past the settings cache, other workers bump it too
+    value = db.session.query(Settings.value).filter_by(key=MATRIX_VERSION_KEY).scalar()
+    return int(value or 0)
+
+
+def get_students_version():
+    """Version of the committed students, through the settings cache"""
+    return int(Settings.get(STUDENTS_VERSION_KEY, 0))
+
+
+def _mark_encodings_changed(session):
+    session.info['face_encodings_changed'] = True
+
+
+@event.listens_for(FaceEncoding, 'after_insert')
+@event.listens_for(FaceEncoding, 'after_delete')
+def _face_encoding_flushed(mapper, connection, target):
+    _mark_encodings_changed(object_session(target))
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _face_encoding_bulk_statement(orm_execute_state):
+    # Bulk statements skip the mapper events above
+    if orm_execute_state.is_select:
+        return
+    if any(mapper.class_ is FaceEncoding for mapper in orm_execute_state.all_mappers):
+        _mark_encodings_changed(orm_execute_state.session)
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_versions(session):
+    # Flush first so changes still pending in the session are seen, then
+    # bump the versions inside the same transaction as the changes
+    session.flush()
+    if session.info.pop('face_encodings_changed', False):
+        Settings.increment(MATRIX_VERSION_KEY, session)
+    if session.info.pop('students_changed', False):
+        Settings.increment(STUDENTS_VERSION_KEY, session)
+        session.info['students_version_bumped'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _reload_bumped_settings(session):
+    # This worker sees its own bump at once, others within the cache TTL
+    if session.info.pop('students_version_bumped', False):
+        Settings.invalidate_cache()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_uncommitted_changes(session):
+    session.info.pop('face_encodings_changed', None)
+    session.info.pop('students_changed', None)
+    session.info.pop('students_version_bumped', None)
 
 
 class Timetable(db.Model):
@@ -54,9 +296,25 @@ class Timetable(db.Model):
     end_time = db.Column(db.Time, nullable=False)
     subject = db.Column(db.String(100), nullable=False)
     
+    __table_args__ = (
+        db.Index('ix_timetable_class_day', 'class_name', 'day_of_week'),
+    )
+    
     def __repr__(self):
-        days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-        return f'<Timetable {self.class_name} - {days[self.day_of_week]} {self.subject}>'
+        return f'<Timetable {self.class_name} - {DAY_NAMES[self.day_of_week]} {self.subject}>'
+    
+    @classmethod
+    def current_subject(cls, class_name=None, now=None):
+        """Get the timetable entry running now, optionally for one class"""
+        now = now or datetime.now()
+        query = cls.query.filter(
+            cls.day_of_week == now.weekday(),
+            cls.start_time <= now.time(),
+            cls.end_time >= now.time()
+        )
+        if class_name is not None:
+            query = query.filter(cls.class_name == class_name)
+        return query.order_by(cls.start_time).first()
 
 
 class Attendance(db.Model):
@@ -64,20 +322,152 @@ class Attendance(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
-    date = db.Column(db.Date, nullable=False, default=date.today)
+    date = db.Column(db.Date, nullable=False, server_default=func.current_date())
     time_marked = db.Column(db.Time, nullable=False)
     subject = db.Column(db.String(100), nullable=False)
     status = db.Column(db.String(20), default='present')  # present, absent, late
     confidence = db.Column(db.Float, default=1.0)  # Recognition confidence
     confirmed = db.Column(db.Boolean, default=True)  # Manual confirmation status
     
-    # Unique constraint: one attendance per student per subject per day
+    # Unique constraint: one attendance per student per subject per day. Its
+    # index also serves per-student (student_id, date) lookups
     __table_args__ = (
         db.UniqueConstraint('student_id', 'date', 'subject', name='unique_attendance'),
+        db.Index('ix_attendance_date_subject', 'date', 'subject'),
     )
     
     def __repr__(self):
-        return f'<Attendance {self.student_id} - {self.date} - {self.subject}>'
+        return f'<{type(self).__name__} {self.id}>'
+    
+    @classmethod
+    def is_marked_today(cls, student_id, subject, today=None):
+        """Check whether a student is already marked for a subject today"""
+        today = today or date.today()
+        key = _marked_key(today, subject)
+        
+        if _marked_cache_contains(key, student_id):
+            return True
+        
+        # The unique constraint stays the source of truth on a cache miss
+        marked = db.session.query(
+            cls.query.filter_by(student_id=student_id, date=today, subject=subject).exists()
+        ).scalar()
+        if marked:
+            _marked_cache_add(key, student_id)
+        return marked
+
+
+# Sets of student ids marked per day and subject, kept in Redis when
+# configured so every worker shares them, otherwise in this process.
+# The local sets only see this worker's deletes, so they are dropped when
+# the students version moves on (a deleted student's id can be reused);
+# multi-worker deployments should set REDIS_URL.
+MARKED_CACHE_TTL = 86400
+_marked_redis = None
+_marked_local = {}
+_marked_local_version = None
+_marked_local_lock = threading.Lock()
+
+
+def configure_attendance_cache(redis_url):
+    """Share the marked attendance cache through Redis at the given URL"""
+    global _marked_redis
+    if redis_url and redis is not None:
+        _marked_redis = redis.Redis.from_url(redis_url)
+
+
+def _marked_key(day, subject):
+    return f'attendance:{day.isoformat()}:{subject}'
+
+
+def _marked_cache_contains(key, student_id):
+    if _marked_redis is not None:
+        try:
+            return bool(_marked_redis.sismember(key, student_id))
+        except redis.RedisError:
+            return False
+    global _marked_local_version
+    version = get_students_version()
+    with _marked_local_lock:
+        if version != _marked_local_version:
+            _marked_local.clear()
+            _marked_local_version = version
+        return student_id in _marked_local.get(key, ())
+
+
+def _marked_cache_add(key, student_id):
+    if _marked_redis is not None:
+        try:
+            _marked_redis.pipeline().sadd(key, student_id).expire(key, MARKED_CACHE_TTL).execute()
+        except redis.RedisError:
+            pass
+        return
+    with _marked_local_lock:
+        # Earlier days are never looked up again
+        today = key.split(':')[1]
+        for stale in [k for k in _marked_local if k.split(':')[1] != today]:
+            del _marked_local[stale]
+        _marked_local.setdefault(key, set()).add(student_id)
+
+
+def _marked_cache_remove(key, student_id):
+    if _marked_redis is not None:
+        try:
+            _marked_redis.srem(key, student_id)
+        except redis.RedisError:
+            pass
+        return
+    with _marked_local_lock:
+        _marked_local.get(key, set()).discard(student_id)
+
+
+@event.listens_for(Attendance, 'after_insert')
+def _attendance_inserted(mapper, connection, target):
+    if target.date is None:  # Left to the server default, not known here
+        return
+    key = _marked_key(target.date, target.subject)
+    object_session(target).info.setdefault('attendance_marked', []).append((key, target.student_id))
+
+
+@event.listens_for(Attendance, 'after_delete')
+def _attendance_deleted(mapper, connection, target):
+    key = _marked_key(target.date, target.subject)
+    object_session(target).info.setdefault('attendance_unmarked', []).append((key, target.student_id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_marked_attendance(session):
+    for key, student_id in session.info.pop('attendance_marked', ()):
+        _marked_cache_add(key, student_id)
+    for key, student_id in session.info.pop('attendance_unmarked', ()):
+        _marked_cache_remove(key, student_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_marked_attendance(session):
+    session.info.pop('attendance_marked', None)
+    session.info.pop('attendance_unmarked', None)
+
+
+class PendingPayload(msgspec.Struct):
+    """Encoding and thumbnail of a pending confirmation, stored as msgpack"""
+    dtype: str
+    shape: tuple[int, ...]
+    encoding: bytes
+    image_jpeg: bytes
+
+
+# Reused for every row, msgspec keeps its encode buffers and type info here
+_payload_encoder = msgspec.msgpack.Encoder()
+_payload_decoder = msgspec.msgpack.Decoder(PendingPayload)
+
+
+def pack_pending_payload(encoding_array, image_jpeg):
+    """Encode a face encoding and JPEG thumbnail as one msgpack payload"""
+    encoding = np.asarray(encoding_array, dtype='<f4')
+    return _payload_encoder.encode(PendingPayload(
+        dtype=encoding.dtype.str, shape=encoding.shape, encoding=encoding.tobytes(), image_jpeg=bytes(image_jpeg)
+    ))
 
 
 class PendingConfirmation(db.Model):
@@ -86,22 +476,39 @@ class PendingConfirmation(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
-    face_encoding = db.Column(db.Text, nullable=False)  # Captured face encoding
-    face_image = db.Column(db.Text, nullable=False)  # Base64 encoded image
+    payload = db.Column(db.LargeBinary, nullable=False)  # PendingPayload msgpack: encoding + JPEG thumbnail
     confidence = db.Column(db.Float, nullable=False)
     subject = db.Column(db.String(100), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), index=True)
     
     student = db.relationship('Student', backref='pending_confirmations')
     
-    def set_encoding(self, encoding_array):
-        self.face_encoding = json.dumps(encoding_array.tolist())
+    def set_payload(self, encoding_array, image_jpeg):
+        self.payload = pack_pending_payload(encoding_array, image_jpeg)
     
-    def get_encoding(self):
-        return json.loads(self.face_encoding)
+    def get_payload(self):
+        """Decode the payload to (encoding, JPEG thumbnail bytes)"""
+        payload = _payload_decoder.decode(self.payload)
+        encoding = np.frombuffer(payload.encoding, dtype=payload.dtype).reshape(payload.shape)
+        return encoding, payload.image_jpeg
+    
+    @classmethod
+    def bulk_delete(cls, ids):
+        """Delete pending confirmations by id in one statement, returns the number removed"""
+        result = db.session.execute(db.delete(cls).where(cls.id.in_(ids)))
+        db.session.commit()
+        return result.rowcount
+    
+    @classmethod
+    def purge_older_than(cls, days):
+        """Delete pending confirmations older than the given number of days"""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        result = db.session.execute(db.delete(cls).where(cls.created_at < cutoff))
+        db.session.commit()
+        return result.rowcount
     
     def __repr__(self):
-        return f'<PendingConfirmation Student {self.student_id} - {self.confidence:.2f}>'
+        return f'<{type(self).__name__} {self.id}>'
 
 
 class Settings(db.Model):
@@ -112,25 +519,204 @@ class Settings(db.Model):
     key = db.Column(db.String(50), unique=True, nullable=False)
     value = db.Column(db.String(200), nullable=False)
     
-    @staticmethod
-    def get(key, default=None):
-        setting = Settings.query.filter_by(key=key).first()
-        return setting.value if setting else default
+    # In-process copy of the whole table, settings are tiny and change rarely.
+    # It is reloaded after CACHE_TTL seconds to pick up other workers' updates
+    CACHE_TTL = 30
+    _cache = None
+    _cache_loaded_at = 0.0
+    _cache_lock = threading.RLock()
+    
+    @classmethod
+    def get(cls, key, default=None):
+        with cls._cache_lock:
+            now = time.monotonic()
+            if cls._cache is None or now - cls._cache_loaded_at > cls.CACHE_TTL:
+                cls._cache = dict(db.session.query(cls.key, cls.value).all())
+                cls._cache_loaded_at = now
+            return cls._cache.get(key, default)
+    
+    @classmethod
+    def set(cls, key, value):
+        cls._upsert(db.session, key, str(value), str(value))
+        db.session.commit()
+        
+        with cls._cache_lock:
+            if cls._cache is not None:
+                cls._cache[key] = str(value)
+    
+    @classmethod
+    def invalidate_cache(cls):
+        """Reload the settings on the next get"""
+        with cls._cache_lock:
+            cls._cache = None
     
-    @staticmethod
-    def set(key, value):
+    @classmethod
+    def increment(cls, key, session=None):
+        """Atomically add one to an integer setting, without committing"""
+        cls._upsert(session or db.session, key, '1', db.cast(db.cast(cls.value, db.Integer) + 1, db.String))
+    
+    # Dialects with an atomic INSERT ... ON CONFLICT DO UPDATE
+    _UPSERT_DIALECTS = {'postgresql': postgresql, 'sqlite': sqlite}
+    
+    @classmethod
+    def _upsert(cls, session, key, insert_value, update_value):
+        """Insert a setting, or set an existing one to update_value"""
+        dialect = cls._UPSERT_DIALECTS.get(session.get_bind().dialect.name)
+        if dialect is not None:
+            # Single statement, concurrent writers cannot race on the insert
+            stmt = dialect.insert(cls).values(key=key, value=insert_value)
+            stmt = stmt.on_conflict_do_update(index_elements=[cls.key], set_={'value': update_value})
+            session.execute(stmt)
+            return
+        
+        # Other backends: update, else insert, and update again if another
+        # writer inserted the key in between
+        update = db.update(cls).where(cls.key == key).values(value=update_value)
+        if session.execute(update).rowcount:
+            return
         try:
-            setting = Settings.query.filter_by(key=key).first()
-            if setting:
-                setting.value = str(value)
-            else:
-                setting = Settings(key=key, value=str(value))
-                db.session.add(setting)
-            db.session.commit()
-        except Exception:
-            # Handle race condition - another worker may have inserted
-            db.session.rollback()
-            setting = Settings.query.filter_by(key=key).first()
-            if setting:
-                setting.value = str(value)
-                db.session.commit()
+            with session.begin_nested():
+                session.execute(db.insert(cls).values(key=key, value=insert_value))
+        except IntegrityError:
+            session.execute(update)
+
+
+def create_missing_indexes():
+    """Create indexes added to the models after their tables already existed"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def _rebuild_sqlite_table(table):
+    """Recreate a SQLite table from its model definition, keeping its rows"""
+    inspector = db.inspect(db.engine)
+    columns = ', '.join(c['name'] for c in inspector.get_columns(table.name) if c['name'] in table.c)
+    old_name = f'{table.name}_old'
+    connection = db.session.connection()
+    
+    for index in inspector.get_indexes(table.name):
+        connection.exec_driver_sql(f'DROP INDEX {index["name"]}')
+    # Legacy rename leaves other tables' foreign keys pointing at the new table
+    connection.exec_driver_sql('PRAGMA legacy_alter_table=ON')
+    connection.exec_driver_sql(f'ALTER TABLE {table.name} RENAME TO {old_name}')
+    connection.exec_driver_sql('PRAGMA legacy_alter_table=OFF')
+    table.create(connection)
+    connection.exec_driver_sql(f'INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}')
+    connection.exec_driver_sql(f'DROP TABLE {old_name}')
+
+
+def migrate_server_defaults():
+    """Add database-side column defaults to tables created before they existed"""
+    inspector = db.inspect(db.engine)
+    
+    for table in db.metadata.sorted_tables:
+        existing = {c['name']: c['default'] for c in inspector.get_columns(table.name)}
+        missing = [
+            column for column in table.columns
+            if column.server_default is not None and existing.get(column.name) is None
+        ]
+        if not missing:
+            continue
+        
+        if db.engine.dialect.name == 'postgresql':
+            for column in missing:
+                default = column.server_default.arg.compile(dialect=db.engine.dialect)
+                db.session.execute(db.text(
+                    f'ALTER TABLE {table.name} ALTER COLUMN {column.name} SET DEFAULT {default}'
+                ))
+        else:
+            # SQLite cannot alter a column default in place
+            _rebuild_sqlite_table(table)
+    
+    db.session.commit()
+
+
+def add_missing_columns():
+    """Add columns introduced after a table was created, they start out NULL"""
+    inspector = db.inspect(db.engine)
+    
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                db.session.execute(db.text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    
+    db.session.commit()
+
+
+def _migrate_text_column(table, column, convert):
+    """Rewrite text values left in a binary column by older versions"""
+    rows = db.session.execute(db.text(f'SELECT id, {column} FROM {table}')).all()
+    legacy = [(row_id, value) for row_id, value in rows if isinstance(value, str)]
+    
+    if db.engine.dialect.name == 'postgresql':
+        # Retype by the declared type, an empty text column needs it as well.
+        # Rows were read above, the column only needs its binary type here
+        column_type = next(
+            c['type'] for c in db.inspect(db.engine).get_columns(table) if c['name'] == column
+        )
+        if not isinstance(column_type, db.LargeBinary):
+            db.session.execute(db.text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE bytea USING ''::bytea"
+            ))
+    
+    if not legacy:
+        return
+    
+    update = db.text(f'UPDATE {table} SET {column} = :value WHERE id = :id').bindparams(
+        db.bindparam('value', type_=db.LargeBinary)
+    )
+    db.session.execute(update, [{'id': row_id, 'value': convert(value)} for row_id, value in legacy])
+
+
+def _json_to_encoding(value):
+    parse_json = orjson.loads if orjson is not None else json.loads
+    return np.asarray(parse_json(value), dtype='<f4').tobytes()
+
+
+def _data_url_to_bytes(value):
+    return base64.b64decode(value.split(',')[-1])
+
+
+def migrate_pending_payloads():
+    """Fold the separate encoding and image columns of older versions into payload"""
+    columns = {c['name'] for c in db.inspect(db.engine).get_columns('pending_confirmations')}
+    if 'face_encoding' not in columns:
+        return
+    
+    rows = db.session.execute(db.text('SELECT id, face_encoding, face_image FROM pending_confirmations')).all()
+    payloads = []
+    for row_id, encoding, image in rows:
+        # Either column may still hold the text formats of even older versions
+        if isinstance(encoding, str):
+            encoding = _json_to_encoding(encoding)
+        if isinstance(image, str):
+            image = _data_url_to_bytes(image)
+        payloads.append({'id': row_id, 'payload': pack_pending_payload(np.frombuffer(encoding, dtype='<f4'), image)})
+    
+    if payloads:
+        update = db.text('UPDATE pending_confirmations SET payload = :payload WHERE id = :id').bindparams(
+            db.bindparam('payload', type_=db.LargeBinary)
+        )
+        db.session.execute(update, payloads)
+    
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text(
+            'ALTER TABLE pending_confirmations DROP COLUMN face_encoding, DROP COLUMN face_image, '
+            'ALTER COLUMN payload SET NOT NULL'
+        ))
+    else:
+        _rebuild_sqlite_table(PendingConfirmation.__table__)
+    db.session.commit()
+
+
+def migrate_face_encodings():
+    """Convert encodings stored as text by older versions to binary"""
+    _migrate_text_column('face_encodings', 'encoding', _json_to_encoding)
+    
+    # Stack encodings of students stored before encodings_blob existed
+    for student_id in db.session.scalars(db.select(Student.id).filter(Student.encodings_blob.is_(None))).all():
+        Student.refresh_encodings(student_id)
+    db.session.commit()
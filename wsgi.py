@@ -3,12 +3,14 @@ WSGI entry point for production deployment
 Used by Gunicorn, uWSGI, or other WSGI servers
 """
 import os
-from app import app, db
+from app import app, init_db
+from face_utils import warm_up_matcher
 
-# Initialize database tables on startup
-with app.app_context():
-    db.create_all()
+# The schema is created by `flask init-db` at deploy time, not on import
 
 if __name__ == "__main__":
+    with app.app_context():
+        init_db()
+    warm_up_matcher()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)